@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Minimal pure-Python stand-in for 'pv -n -t -b'.
+Fallback path only: app.py uses it when the 'pv' binary is not installed.
+Copies stdin to stdout in 64KB chunks and prints "<elapsed> <bytes>" lines
+on stderr, the same numeric format pv emits, so the app parses both alike.
+"""
+import argparse
+import os
+import sys
+import time
+
+CHUNK_SIZE = 65536
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipe pump with pv-style numeric progress")
+    parser.add_argument("-s", "--size", type=int, default=0, help="expected size (unused, kept for pv parity)")
+    parser.add_argument("-i", "--interval", type=float, default=1.0, help="seconds between progress lines")
+    args = parser.parse_args()
+
+    in_fd = sys.stdin.fileno()
+    out_fd = sys.stdout.fileno()
+    start = time.monotonic()
+    next_report = start + args.interval
+    total = 0
+
+    try:
+        while True:
+            # فقط bytes؛ هیچ decode/encode در مسیر داده انجام نمی شود
+            chunk = os.read(in_fd, CHUNK_SIZE)
+            if not chunk:
+                break
+            view = memoryview(chunk)
+            while view:
+                written = os.write(out_fd, view)
+                view = view[written:]
+            total += len(chunk)
+
+            now = time.monotonic()
+            if now >= next_report:
+                sys.stderr.write(f"{now - start:.4f} {total}\n")
+                sys.stderr.flush()
+                next_report = now + args.interval
+    except BrokenPipeError:
+        # مرحله بعدی pipeline بسته شده؛ خطای اصلی را همان مرحله گزارش می دهد
+        return 1
+
+    sys.stderr.write(f"{time.monotonic() - start:.4f} {total}\n")
+    sys.stderr.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
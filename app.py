@@ -9,7 +9,20 @@ import subprocess
 import threading
 import sys
 import time
+import json
+import collections
+import functools
+import re
+import shlex
+import shutil
+import uuid
+import select
+import pty
+import fcntl
+import struct
+import termios
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # تنظیمات سیستم لاگ (نمایش در ترمینال)
 logging.basicConfig(
@@ -23,7 +36,7 @@ try:
     import gi
     gi.require_version("Gtk", "4.0")
     gi.require_version("Adw", "1")
-    from gi.repository import Gtk, Adw, Gio, GLib
+    from gi.repository import Gtk, Adw, Gio, GLib, GObject
 except Exception as e:
     logger.critical(f"Required GTK4 bindings missing: {e}")
     sys.exit(1)
@@ -33,22 +46,187 @@ DEVICE_DIR = "/sdcard/Transfer"
 REMOTE_BASE_DIR = "/sdcard"
 REMOTE_TARGET_DIR_NAME = "Transfer" # نام پوشه ای که آرشیو می شود
 
+# فاصله زمانی به‌روزرسانی نوار پیشرفت در حلقه اصلی GTK (میلی‌ثانیه)
+PROGRESS_PUMP_INTERVAL_MS = 100
+
+# خروجی 'pv -n -t -b': زمان سپری شده و تعداد بایت در هر خط
+PV_NUMERIC_RE = re.compile(rb"^(\d+(?:\.\d+)?)\s+(\d+)$")
+
+# خط پیشرفت 'adb pull' روی ترمینال: "[ 42%] /sdcard/Transfer/..."
+ADB_PULL_PROGRESS_RE = re.compile(rb"^\[\s*(\d+)%\]")
+# کدهای کنترلی ترمینال (مثل \x1b[K) و خطوط پیشرفت/خلاصه که خطا نیستند
+ANSI_ESCAPE_RE = re.compile(rb"\x1b\[[0-9;?]*[A-Za-z]")
+ADB_PULL_NOISE_RE = re.compile(rb"^\[[^\]]*\]|\d+ files? pulled")
+
+# حداقل فاصله پردازش تغییر اندازه پنجره (میلی‌ثانیه)
+RESIZE_DEBOUNCE_MS = 50
+
+# کش اندازه پوشه ریموت (بر اساس سریال دستگاه و mtime پوشه)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "adbtransfer"
+)
+SIZE_CACHE_FILE = os.path.join(CACHE_DIR, "sizes.json")
+
+# گزینه های tar محلی (GNU tar): بدون xattr/ACL؛ رکوردهای 1MB (2048 × 512) فقط هنگام استخراج.
+# در ساخت آرشیو -b نمی گذاریم: padding تا 1MB توسط tar دستگاه خوانده نمی شود و
+# مراحل قبلی pipeline با SIGPIPE تمام می شوند.
+LOCAL_TAR_CREATE_OPTS = ["--no-xattrs", "--no-acls", "--numeric-owner"]
+LOCAL_TAR_EXTRACT_OPTS = ["--no-same-owner", "--no-xattrs", "--no-acls", "-b", "2048"]
+
+# جایگزین پایتونی pv وقتی pv نصب نیست
+PVPY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_pvpy.py")
+
+# فشرده سازی LZ4 روی کانال adb (سطح پیش فرض: سریع ترین)
+LZ4_DEFAULT_LEVEL = 1
+LZ4_MAX_LEVEL = 9
+
+# حداکثر زمان انتظار برای پاسخ هر دستور در session دائمی adb shell (ثانیه)
+ADB_SHELL_TIMEOUT = 30.0
+
+# مدت اعتبار نتیجه موفق 'adb get-state' (ثانیه)
+ADB_STATE_TTL = 2.0
+
+# محاسبه موازی اندازه پوشه محلی
+LOCAL_SIZE_WORKERS = 8
+LOCAL_SIZE_PARALLEL_THRESHOLD = 256  # زیر این تعداد ورودی، محاسبه ترتیبی انجام می شود
+
 # --- Functional Helpers ---
 
+# CPython only takes the posix_spawn() path (no fork() of this large GTK
+# process) when the executable is given as a path and close_fds is False.
+# Leaving fds open is safe: Python creates them non-inheritable (PEP 446).
+SPAWN_KWARGS = {"close_fds": False}
+
+def _spawn_argv(argv):
+    """Returns argv with the executable resolved to an absolute path."""
+    return [shutil.which(argv[0]) or argv[0], *argv[1:]]
+
+def _run_captured(argv):
+    """subprocess.run with captured text output, spawned via posix_spawn."""
+    return subprocess.run(
+        _spawn_argv(argv), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **SPAWN_KWARGS
+    )
+
+@functools.lru_cache(maxsize=4096)
+def _format_speed_cached(value, unit):
+    return f"{value:.0f} {unit}" if unit == "B/s" else f"{value:.1f} {unit}"
+
 def format_speed(bytes_per_sec):
     """Converts bytes/sec to human readable string."""
+    # کلید کش همان مقدار گرد شده نمایشی است؛ round() همان گرد کردن f-string را انجام می دهد
     if bytes_per_sec < 1024:
-        return f"{bytes_per_sec:.0f} B/s"
+        return _format_speed_cached(round(bytes_per_sec), "B/s")
     elif bytes_per_sec < 1024**2:
-        return f"{bytes_per_sec/1024:.1f} KB/s"
+        return _format_speed_cached(round(bytes_per_sec / 1024, 1), "KB/s")
     else:
-        return f"{bytes_per_sec/(1024**2):.1f} MB/s"
+        return _format_speed_cached(round(bytes_per_sec / (1024**2), 1), "MB/s")
+
+def warm_up_adb():
+    """Starts the adb server ahead of time so the first real command doesn't pay for it."""
+    try:
+        res = _run_captured(["adb", "start-server"])
+        if res.returncode != 0:
+            logger.warning(f"adb start-server failed: {res.stderr.strip()}")
+    except Exception as e:
+        logger.warning(f"Could not start adb server: {e}")
+
+class AdbShellSession:
+    """A long-lived 'adb shell' that runs helper commands over one connection.
+
+    Each command is followed by an echoed sentinel carrying its exit code, so
+    output can be read back without reconnecting. The session is reopened
+    transparently if the shell exits (e.g. the device was unplugged).
+    """
+
+    def __init__(self):
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._process is None or self._process.poll() is not None:
+            logger.debug("Opening persistent adb shell session")
+            self._process = subprocess.Popen(
+                # -T: بدون pty تا دستورها echo نشوند و پایان خط ها دست نخورند
+                _spawn_argv(["adb", "shell", "-T"]),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                bufsize=0,
+                **SPAWN_KWARGS,
+            )
+
+    def run(self, command, timeout=ADB_SHELL_TIMEOUT):
+        """Runs command on the device; returns (returncode, output) or None.
+
+        None means the session broke or no answer arrived within ``timeout``
+        seconds (``None`` waits indefinitely); the session is then closed and
+        reopened on the next call. The command's stdin is /dev/null so it
+        cannot swallow the sentinel line meant for the shell.
+        """
+        with self._lock:
+            try:
+                self._ensure_started()
+                sentinel = f"__END_{uuid.uuid4().hex}__"
+                # newline قبل از sentinel تا خروجی بدون newline پایانی آن را نپوشاند
+                self._process.stdin.write(f"{{ {command}; }} </dev/null 2>&1; printf '\\n%s %s\\n' {sentinel} $?\n".encode())
+                self._process.stdin.flush()
+
+                marker = b"\n" + sentinel.encode() + b" "
+                fd = self._process.stdout.fileno()
+                deadline = None if timeout is None else time.monotonic() + timeout
+                buf = b""
+                while True:
+                    idx = buf.find(marker)
+                    if idx != -1 and buf.endswith(b"\n"):
+                        returncode = int(buf[idx + len(marker):].split()[0])
+                        return returncode, buf[:idx].decode("utf-8", "replace")
+
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if (remaining is not None and remaining <= 0) or not select.select([fd], [], [], remaining)[0]:
+                        logger.warning(f"adb shell session timed out running: {command}")
+                        break
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    buf += chunk
+            except (OSError, ValueError) as e:
+                logger.debug(f"adb shell session error: {e}")
+
+            # EOF، timeout یا خطا: session بعدی از نو ساخته می شود
+            self._close_locked()
+            return None
+
+    def _close_locked(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def close(self):
+        with self._lock:
+            self._close_locked()
+
+adb_session = AdbShellSession()
+
+def adb_shell(args, timeout=ADB_SHELL_TIMEOUT):
+    """Runs a device command through the shared session, falling back to a one-off 'adb shell'."""
+    result = adb_session.run(shlex.join(args), timeout)
+    if result is None:
+        return _run_captured(["adb", "shell", *args])
+    returncode, output = result
+    # stderr با stdout ادغام شده است
+    return subprocess.CompletedProcess(args, returncode, output, output if returncode != 0 else "")
 
 def check_adb_device():
     """Checks ADB connection state."""
     logger.debug("Checking for ADB device...")
     try:
-        res = subprocess.run(["adb", "get-state"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        res = _run_captured(["adb", "get-state"])
         if res.returncode != 0:
             logger.error(f"ADB Connection Failed: {res.stderr.strip()}")
             return False
@@ -57,19 +235,86 @@ def check_adb_device():
         logger.exception("Exception in check_adb_device")
         return False
 
-def get_remote_size(remote_path):
-    """Calculate size of the remote folder in bytes."""
+def probe_lz4():
+    """Returns True if lz4 is available both locally and on the device."""
+    if shutil.which("lz4") is None:
+        logger.info("lz4 not found locally, compression disabled")
+        return False
+    try:
+        res = adb_shell(["command", "-v", "lz4"])
+        if res.returncode != 0 or not res.stdout.strip():
+            logger.info("lz4 not found on device, compression disabled")
+            return False
+        return True
+    except Exception as e:
+        logger.error(f"Error probing lz4 on device: {e}")
+        return False
+
+def _load_size_cache():
+    try:
+        with open(SIZE_CACHE_FILE, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # فایل خراب یا دستکاری شده نباید محاسبه اندازه را از کار بیندازد
+    return cache if isinstance(cache, dict) else {}
+
+def _save_size_cache(cache):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = SIZE_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, SIZE_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Could not write size cache: {e}")
+
+def get_device_serial():
+    """Returns the connected device's serial, or "" if it can't be read."""
+    try:
+        res = _run_captured(["adb", "get-serialno"])
+        if res.returncode == 0:
+            return res.stdout.strip()
+    except Exception as e:
+        logger.error(f"Error reading device serial: {e}")
+    return ""
+
+def get_remote_size(remote_path, serial):
+    """Calculate size of the remote folder in bytes.
+
+    The result of the (slow) 'du' walk is cached on disk, keyed on the
+    device ``serial`` (looked up once per transfer by the caller), the path
+    and the folder's mtime. Without a serial the cache is skipped.
+    """
     logger.debug(f"Calculating remote size for {remote_path}...")
     try:
+        mtime_res = adb_shell(["stat", "-c", "%Y", remote_path])
+
+        cache_key = None
+        if serial and mtime_res.returncode == 0:
+            cache_key = f"{serial}:{remote_path}:{mtime_res.stdout.strip()}"
+            cache = _load_size_cache()
+            size_bytes = cache.get(cache_key)
+            if isinstance(size_bytes, int) and not isinstance(size_bytes, bool) and size_bytes >= 0:
+                logger.info(f"Remote size (cached): {size_bytes} bytes")
+                return size_bytes
+
         # استفاده از 'du -s -b' (bytes) برای محاسبه دقیق
-        cmd = ["adb", "shell", "du", "-s", "-b", remote_path] 
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # بدون timeout: پیمایش کند du نباید قطع و دوباره از اول اجرا شود
+        result = adb_shell(["du", "-s", "-b", remote_path], timeout=None)
         if result.returncode == 0:
             output = result.stdout.strip()
             if output:
                 # خروجی: 174598144  /sdcard/Transfer
                 size_bytes = int(output.split()[0])
                 logger.info(f"Remote size: {size_bytes} bytes")
+                if cache_key:
+                    cache = _load_size_cache()
+                    # فقط آخرین mtime هر مسیر نگه داشته می شود
+                    prefix = cache_key.rsplit(":", 1)[0] + ":"
+                    cache = {k: v for k, v in cache.items() if not k.startswith(prefix)}
+                    cache[cache_key] = size_bytes
+                    _save_size_cache(cache)
                 return size_bytes
         else:
             logger.error(f"Failed to get remote size. Check existence: {result.stderr}")
@@ -77,66 +322,301 @@ def get_remote_size(remote_path):
         logger.error(f"Error calculating remote size: {e}")
     return 0
 
+def _scan_level(dirs):
+    """Scans one directory level; returns (file bytes, subdirs, entry count)."""
+    total = 0
+    subdirs = []
+    entries = 0
+    for d in dirs:
+        try:
+            # scandir returns type info from readdir, so no extra stat/islink per entry
+            with os.scandir(d) as it:
+                for entry in it:
+                    entries += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif not entry.is_symlink():
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError as e:
+            logger.debug(f"Skipping {d}: {e}")
+    return total, subdirs, entries
+
+def _tree_size(path):
+    """Sequential size of a directory tree."""
+    total = 0
+    stack = [path]
+    while stack:
+        size, subdirs, _ = _scan_level([stack.pop()])
+        total += size
+        stack.extend(subdirs)
+    return total
+
 def get_local_size(path):
     """Calculate size of local directory recursively."""
     logger.debug(f"Calculating local size for: {path}")
     total_size = 0
     try:
-        for dirpath, _, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if not os.path.islink(fp):
-                    total_size += os.path.getsize(fp)
+        # پیمایش سطح به سطح (BFS) تا وقتی درخت کوچک است؛ پس از عبور از آستانه،
+        # پوشه های باقیمانده (سطوح بالایی) بین threadها تقسیم می شوند
+        pending = collections.deque([path])
+        entries = 0
+        while pending and (entries < LOCAL_SIZE_PARALLEL_THRESHOLD or len(pending) < 2):
+            size, subdirs, level_entries = _scan_level([pending.popleft()])
+            total_size += size
+            entries += level_entries
+            pending.extend(subdirs)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=LOCAL_SIZE_WORKERS) as pool:
+                total_size += sum(pool.map(_tree_size, pending))
         logger.info(f"Local size: {total_size} bytes")
     except Exception as e:
         logger.error(f"Error calculating local size: {e}")
     return total_size
 
-def run_adb_command_with_progress(cmd_list, update_callback, finished_callback):
-    """Runs shell command, captures pv progress and error output."""
-    logger.info(f"Executing Command: {cmd_list}")
-    
-    process = subprocess.Popen(
-        cmd_list,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE, 
-        text=True,
-        bufsize=1,
-        universal_newlines=True
+def build_progress_stage(size_bytes):
+    """The progress-measuring stage: pv if installed, else the bundled _pvpy.py fallback."""
+    if shutil.which("pv"):
+        return ["pv", "-n", "-t", "-b", "-s", str(size_bytes)]
+    logger.warning("pv not found, using the built-in Python progress pump")
+    return [sys.executable, PVPY_PATH, "-s", str(size_bytes)]
+
+def build_pull_stages(local_path, size_bytes, lz4_level=None):
+    """Pipeline stages for Phone -> PC. pv always measures uncompressed bytes."""
+    remote_cmd = f"cd {REMOTE_BASE_DIR} && tar -c -f - {REMOTE_TARGET_DIR_NAME}"
+    stages = []
+    if lz4_level:
+        stages.append(["adb", "exec-out", f"{remote_cmd} | lz4 -{lz4_level} -c"])
+        stages.append(["lz4", "-d", "-c"])
+    else:
+        stages.append(["adb", "exec-out", remote_cmd])
+    stages.append(build_progress_stage(size_bytes))
+    stages.append(["tar", *LOCAL_TAR_EXTRACT_OPTS, "-xf", "-", "-C", local_path])
+    return stages
+
+def build_push_stages(local_path, size_bytes, lz4_level=None):
+    """Pipeline stages for PC -> Phone. pv always measures uncompressed bytes."""
+    stages = [
+        ["tar", *LOCAL_TAR_CREATE_OPTS, "-cf", "-", "-C", local_path, "."],
+        build_progress_stage(size_bytes),
+    ]
+    if lz4_level:
+        stages.append(["lz4", f"-{lz4_level}", "-c"])
+        stages.append(["adb", "shell", f"mkdir -p {DEVICE_DIR} && lz4 -d -c | tar -xf - -C {DEVICE_DIR}"])
+    else:
+        stages.append(["adb", "shell", f"mkdir -p {DEVICE_DIR} && tar -xf - -C {DEVICE_DIR}"])
+    return stages
+
+def spawn_pipeline(stages, stderr_fd):
+    """Starts each argv in ``stages`` connected stdout -> stdin, like a shell pipe.
+
+    Every stage writes its stderr to ``stderr_fd``. If a stage fails to start,
+    the already running ones are killed and the OSError is re-raised.
+    """
+    procs = []
+    prev_stdout = subprocess.DEVNULL
+    try:
+        for i, argv in enumerate(stages):
+            is_last = (i == len(stages) - 1)
+            proc = subprocess.Popen(
+                _spawn_argv(argv),
+                stdin=prev_stdout,
+                stdout=subprocess.DEVNULL if is_last else subprocess.PIPE,
+                stderr=stderr_fd,
+                **SPAWN_KWARGS,
+            )
+            # فقط فرزند بعدی باید سر pipe را نگه دارد
+            if prev_stdout is not subprocess.DEVNULL:
+                prev_stdout.close()
+            prev_stdout = proc.stdout
+            procs.append(proc)
+    except OSError:
+        if prev_stdout is not subprocess.DEVNULL:
+            prev_stdout.close()
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    return procs
+
+def _watch_lines(fd, on_line, on_eof, separator=rb"\n"):
+    """Reads fd from the GTK main loop and calls on_line for each stripped line.
+
+    on_eof is called once the writers are gone; the fd is closed before that.
+    """
+    buf = b""
+
+    def _on_readable(fd, condition):
+        nonlocal buf
+        try:
+            chunk = os.read(fd, 4096)
+        except OSError:
+            # EIO روی pty وقتی همه سرهای slave بسته شده اند
+            chunk = b""
+        if not chunk:
+            if buf.strip():
+                on_line(buf.strip())
+            os.close(fd)
+            on_eof()
+            return False
+
+        *lines, buf = re.split(separator, buf + chunk)
+        for line in lines:
+            on_line(line.strip())
+        return True
+
+    GLib.unix_fd_add_full(
+        GLib.PRIORITY_DEFAULT, fd,
+        GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+        _on_readable
     )
 
-    captured_errors = []
+def _finish_when_exited(procs, on_exit):
+    """Calls on_exit(return_codes) from the main loop once every process has exited."""
+    def _check():
+        if any(proc.poll() is None for proc in procs):
+            return True
+        on_exit([proc.returncode for proc in procs])
+        return False
+
+    if _check():
+        GLib.timeout_add(50, _check)
+
+def _report_result(state, return_codes, captured_errors):
+    success = all(rc == 0 for rc in return_codes)
+    error_msg = "\n".join(captured_errors) if not success else ""
+
+    if not success:
+        logger.error(f"Process finished with error codes {return_codes}")
+        logger.error(f"Error Output: {error_msg}")
+
+    state.update(success=success, err=error_msg, done=True)
+
+def run_adb_command_with_progress(stages, total_bytes, state):
+    """Runs the transfer pipeline, captures pv progress and error output.
+
+    Spawning happens in the calling (worker) thread; the shared stderr pipe
+    is then watched on the GTK main loop with GLib.unix_fd_add_full instead
+    of a reader thread. ``state`` has no lock: the worker writes it only
+    before any main-loop source for this transfer exists (the reset in
+    _start_transfer, a spawn failure here). Attaching the fd watch and the
+    pump (GLib.timeout_add) takes the main context's lock, so those writes
+    are visible to every later callback; from then on only main-loop
+    callbacks write ``state``. The progress stage
+    (pv ``-n -t -b`` or _pvpy.py) prints its own timer and byte count per line.
+    The latest (fraction, bytes/sec) pair is stored in ``state['progress']``
+    and the final result in ``state['done'/'success'/'err']``, for the
+    periodic UI pump to pick up.
+    """
+    logger.info(f"Executing Command: {' | '.join(shlex.join(argv) for argv in stages)}")
+
+    err_r, err_w = os.pipe()
+    try:
+        procs = spawn_pipeline(stages, err_w)
+    except OSError as e:
+        os.close(err_r)
+        logger.error(f"Failed to start pipeline: {e}")
+        state.update(success=False, err=str(e), done=True)
+        return
+    finally:
+        os.close(err_w)
 
-    def read_stderr():
-        while True:
-            line = process.stderr.readline()
-            if not line and process.poll() is not None:
-                break
+    captured_errors = []
+    last_elapsed = 0.0
+    last_bytes = 0
+
+    def on_line(line):
+        nonlocal last_elapsed, last_bytes
+        # Binary mode: pv only prints ASCII digits, so skip the text codec entirely
+        match = PV_NUMERIC_RE.match(line)
+        if not match:
+            # Not a pv progress line, likely an error or debug text
             if line:
-                line_str = line.strip()
-                try:
-                    # Attempt to parse as progress percentage from pv -n
-                    percent = float(line_str)
-                    GLib.idle_add(update_callback, percent / 100.0)
-                except ValueError:
-                    # Not a number, likely an error or debug text
-                    if line_str:
-                        captured_errors.append(line_str)
-                        logger.debug(f"CMD STDERR: {line_str}")
-        
-        rc = process.poll()
-        success = (rc == 0)
-        error_msg = "\n".join(captured_errors) if not success else ""
-        
-        if not success:
-            logger.error(f"Process finished with error code {rc}")
-            logger.error(f"Error Output: {error_msg}")
+                line_str = line.decode("utf-8", "replace")
+                captured_errors.append(line_str)
+                logger.debug(f"CMD STDERR: {line_str}")
+            return
+
+        elapsed = float(match.group(1))
+        done_bytes = int(match.group(2))
+        # سرعت از زمان‌سنج خود pv محاسبه می شود، نه از ساعت رابط کاربری
+        time_delta = elapsed - last_elapsed
+        speed = (done_bytes - last_bytes) / time_delta if time_delta > 0 else 0.0
+        last_elapsed, last_bytes = elapsed, done_bytes
+        fraction = min(done_bytes / total_bytes, 1.0) if total_bytes > 0 else 0.0
+        state['progress'] = (fraction, speed)
+
+    # EOF arrives once every stage has closed its end of the stderr pipe
+    _watch_lines(
+        err_r, on_line,
+        lambda: _finish_when_exited(procs, lambda rcs: _report_result(state, rcs, captured_errors))
+    )
+
+def run_adb_pull_with_progress(remote_path, local_path, total_bytes, state):
+    """Pulls remote_path with 'adb pull -a' (sync protocol), parsing adb's own progress.
+
+    adb only prints its "[ NN%]" progress on a terminal, so its output is
+    attached to a pty. Like run_adb_command_with_progress, it spawns in the
+    calling thread and reports progress and the result from the main loop.
+    """
+    cmd = ["adb", "pull", "-a", remote_path, local_path]
+    logger.info(f"Executing Command: {shlex.join(cmd)}")
+
+    try:
+        master_fd, slave_fd = pty.openpty()
+    except OSError as e:
+        logger.error(f"Failed to open a pty for adb pull: {e}")
+        state.update(success=False, err=str(e), done=True)
+        return
+
+    env = dict(os.environ)
+    if env.get("TERM", "dumb") == "dumb":
+        env["TERM"] = "xterm"
+    try:
+        # عرض ترمینال پهن تا adb خط پیشرفت را کوتاه نکند
+        fcntl.ioctl(slave_fd, termios.TIOCSWINSZ, struct.pack("HHHH", 24, 512, 0, 0))
+        process = subprocess.Popen(
+            _spawn_argv(cmd), stdin=subprocess.DEVNULL, stdout=slave_fd, stderr=slave_fd, env=env, **SPAWN_KWARGS
+        )
+    except OSError as e:
+        os.close(master_fd)
+        logger.error(f"Failed to start adb pull: {e}")
+        state.update(success=False, err=str(e), done=True)
+        return
+    finally:
+        os.close(slave_fd)
 
-        GLib.idle_add(finished_callback, success, error_msg)
+    captured_errors = []
+    last_time = time.monotonic()
+    last_bytes = 0
+    speed = 0.0
+
+    def on_line(line):
+        nonlocal last_time, last_bytes, speed
+        line = ANSI_ESCAPE_RE.sub(b"", line).strip()
+        match = ADB_PULL_PROGRESS_RE.match(line)
+        if not match:
+            if line and not ADB_PULL_NOISE_RE.search(line):
+                line_str = line.decode("utf-8", "replace")
+                captured_errors.append(line_str)
+                logger.debug(f"ADB PULL: {line_str}")
+            return
 
-    t = threading.Thread(target=read_stderr, daemon=True)
-    t.start()
+        fraction = int(match.group(1)) / 100.0
+        done_bytes = fraction * total_bytes
+        now = time.monotonic()
+        time_delta = now - last_time
+        # درصد adb درشت است؛ سرعت روی بازه های حداقل نیم ثانیه ای حساب می شود
+        if time_delta >= 0.5:
+            speed = max((done_bytes - last_bytes) / time_delta, 0.0)
+            last_time, last_bytes = now, done_bytes
+        state['progress'] = (fraction, speed)
+
+    _watch_lines(
+        master_fd, on_line,
+        lambda: _finish_when_exited([process], lambda rcs: _report_result(state, rcs, captured_errors)),
+        separator=rb"[\r\n]"
+    )
 
 # --- UI Application ---
 
@@ -144,12 +624,19 @@ class ADBTransferApp(Adw.Application):
     def __init__(self):
         super().__init__(application_id="org.example.adbtransfer")
         self.connect("activate", self.on_activate)
+        self.connect("shutdown", self.on_shutdown)
         
-        self.total_bytes = 0
-        self.last_fraction = 0.0
-        self.last_time = 0.0
+        self._adb_ok_until = 0.0
+        self._lz4_available = {}  # serial دستگاه -> نتیجه probe_lz4
+        self._resize_source = 0
+        self._last_pct = -1
+        self._last_frac = -1.0
+        self._progress_state = {'progress': None, 'done': False, 'success': None, 'err': ''}
 
     def on_activate(self, app):
+        # سرور adb در پس زمینه بالا می آید تا اولین انتقال منتظر آن نماند
+        threading.Thread(target=warm_up_adb, daemon=True).start()
+
         self.window = Adw.ApplicationWindow(application=self)
         self.window.set_title("ADB Transfer Tool")
         self.window.set_default_size(500, 350)
@@ -207,6 +694,37 @@ class ADBTransferApp(Adw.Application):
         path_row.add_suffix(path_box)
         controls_grp.add(path_row)
 
+        compress_row = Adw.ActionRow(title="LZ4 Compression", subtitle="Level (needs lz4 on PC and phone)")
+        self.compress_switch = Gtk.Switch()
+        self.compress_switch.set_valign(Gtk.Align.CENTER)
+        self.compress_level = Gtk.SpinButton.new_with_range(1, LZ4_MAX_LEVEL, 1)
+        self.compress_level.set_value(LZ4_DEFAULT_LEVEL)
+        self.compress_level.set_valign(Gtk.Align.CENTER)
+        self.compress_switch.bind_property(
+            "active", self.compress_level, "sensitive", GObject.BindingFlags.SYNC_CREATE
+        )
+
+        compress_box = Gtk.Box(spacing=10)
+        compress_box.append(self.compress_level)
+        compress_box.append(self.compress_switch)
+        compress_row.add_suffix(compress_box)
+        controls_grp.add(compress_row)
+
+        sync_row = Adw.ActionRow(title="Native adb pull", subtitle="Pull with adb's sync protocol instead of tar")
+        self.sync_switch = Gtk.Switch()
+        self.sync_switch.set_valign(Gtk.Align.CENTER)
+        self.mode_pull.bind_property(
+            "active", sync_row, "sensitive", GObject.BindingFlags.SYNC_CREATE
+        )
+        sync_row.add_suffix(self.sync_switch)
+        controls_grp.add(sync_row)
+
+        # adb pull بدون tar است و فشرده سازی در آن اعمال نمی شود
+        self._compress_row = compress_row
+        self.sync_switch.connect("notify::active", self._update_compress_sensitivity)
+        self.mode_pull.connect("notify::active", self._update_compress_sensitivity)
+        self._update_compress_sensitivity()
+
         self.progress_bar = Gtk.ProgressBar()
         self.progress_bar.set_text("0%")
         self.progress_bar.set_show_text(True)
@@ -226,10 +744,25 @@ class ADBTransferApp(Adw.Application):
 
         self.window.present()
 
+    def _update_compress_sensitivity(self, *args):
+        use_sync = self.mode_pull.get_active() and self.sync_switch.get_active()
+        self._compress_row.set_sensitive(not use_sync)
+
+    def on_shutdown(self, app):
+        adb_session.close()
+
     def on_window_resize(self, window, param):
-        w = window.get_width()
-        h = window.get_height()
+        # width و height هر دو به ازای هر پیکسل سیگنال می دهند؛ یک بار در هر 50ms کافی است
+        if self._resize_source:
+            return
+        self._resize_source = GLib.timeout_add(RESIZE_DEBOUNCE_MS, self._do_resize)
+
+    def _do_resize(self):
+        self._resize_source = 0
+        w = self.window.get_width()
+        h = self.window.get_height()
         # print(f"Resize: {w}x{h}")
+        return False
 
     def on_browse(self, button):
         dialog = Gtk.FileChooserNative(
@@ -247,29 +780,36 @@ class ADBTransferApp(Adw.Application):
                 self.path_entry.set_text(file.get_path())
         dialog.destroy()
 
-    def update_ui_progress(self, fraction):
-        current_time = time.time()
-        
-        if self.total_bytes > 0 and self.last_time > 0:
-            time_delta = current_time - self.last_time
-            if time_delta > 0.5:
-                fraction_delta = fraction - self.last_fraction
-                
-                if fraction_delta >= 0:
-                    bytes_delta = fraction_delta * self.total_bytes
-                    speed = bytes_delta / time_delta
-                    self.speed_label.set_text(format_speed(speed))
-                
-                self.last_time = current_time
-                self.last_fraction = fraction
-
-        self.progress_bar.set_fraction(fraction)
-        self.progress_bar.set_text(f"{int(fraction * 100)}%")
+    def update_ui_progress(self, fraction, speed):
+        self.speed_label.set_text(format_speed(speed))
+        # فقط وقتی مقدار قابل مشاهده تغییر کرده property ویجت نوشته شود
+        pct = int(fraction * 100)
+        if pct != self._last_pct:
+            self.progress_bar.set_text(f"{pct}%")
+            self._last_pct = pct
+        if abs(fraction - self._last_frac) >= 0.005:
+            self.progress_bar.set_fraction(fraction)
+            self._last_frac = fraction
+
+    def _pump_progress(self):
+        state = self._progress_state
+        if state['done']:
+            self.on_transfer_finished(state['success'], state['err'])
+            return False
+
+        progress = state['progress']
+        if progress is not None:
+            state['progress'] = None
+            self.update_ui_progress(*progress)
+        return True
 
     def on_transfer_finished(self, success, error_msg=""):
         self.start_btn.set_sensitive(True)
         self.progress_bar.set_opacity(0.0)
         self.progress_bar.set_fraction(0)
+        self.progress_bar.set_text("0%")
+        self._last_pct = -1
+        self._last_frac = -1.0
         self.speed_label.set_opacity(0.0)
         
         if success:
@@ -277,6 +817,9 @@ class ADBTransferApp(Adw.Application):
             self._show_toast("Success!")
             logger.info("Transfer finished successfully.")
         else:
+            # ممکن است دستگاه قطع شده باشد؛ دفعه بعد دوباره بررسی شود
+            self._adb_ok_until = 0.0
+            self._lz4_available.clear()
             self.status_label.set_text("Transfer Failed")
             logger.error(f"Transfer finished with errors: {error_msg}")
             
@@ -295,6 +838,8 @@ class ADBTransferApp(Adw.Application):
             return
 
         is_pull = self.mode_pull.get_active()
+        lz4_level = self.compress_level.get_value_as_int() if self.compress_switch.get_active() else None
+        use_sync = is_pull and self.sync_switch.get_active()
         
         logger.info(f"Starting transfer. Mode={'Pull' if is_pull else 'Push'}, Path={local_path}")
         
@@ -304,40 +849,75 @@ class ADBTransferApp(Adw.Application):
         self.speed_label.set_opacity(1.0)
         self.speed_label.set_text("Calculating...")
         
-        self.last_fraction = 0.0
-        self.last_time = time.time()
-        
         t = threading.Thread(
             target=self._prepare_and_run, 
-            args=(is_pull, local_path), 
+            args=(is_pull, local_path, lz4_level, use_sync), 
             daemon=True
         )
         t.start()
 
-    def _prepare_and_run(self, is_pull, local_path):
+    def _check_device(self):
+        """check_adb_device() with a short-lived cache of the positive result."""
+        if time.monotonic() < self._adb_ok_until:
+            logger.debug("ADB device state cached as OK")
+            return True
         if not check_adb_device():
+            return False
+        self._adb_ok_until = time.monotonic() + ADB_STATE_TTL
+        return True
+
+    def _start_transfer(self, runner, *args):
+        """Starts ``runner`` from the worker thread, then the periodic UI pump.
+
+        Processes are spawned here; only the fd watch and the pump are
+        attached to the GTK main loop.
+        """
+        GLib.idle_add(lambda: self.status_label.set_text("Transferring..."))
+        self._progress_state.update(progress=None, done=False, success=None, err='')
+        try:
+            runner(*args, self._progress_state)
+        except Exception as e:
+            logger.exception("Failed to start transfer")
+            self._progress_state.update(success=False, err=str(e), done=True)
+        # pump همیشه شروع می شود تا on_transfer_finished حتماً اجرا شود
+        GLib.timeout_add(PROGRESS_PUMP_INTERVAL_MS, self._pump_progress)
+
+    def _prepare_and_run(self, is_pull, local_path, lz4_level=None, use_sync=False):
+        if not self._check_device():
             GLib.idle_add(lambda: self.status_label.set_text("Device Error"))
             GLib.idle_add(self.on_transfer_finished, False, "ADB Device not connected or unauthorized")
             return
 
+        # یک بار برای هر انتقال؛ هم کش اندازه و هم نتیجه probe_lz4 با آن کلید می خورند
+        serial = get_device_serial() if (is_pull or lz4_level) else ""
+
+        if is_pull and use_sync:
+            if lz4_level:
+                logger.info("LZ4 compression is not used with native adb pull")
+            self._prepare_and_run_sync(local_path, serial)
+            return
+
+        if lz4_level:
+            if serial not in self._lz4_available:
+                self._lz4_available[serial] = probe_lz4()
+            if not self._lz4_available[serial]:
+                logger.warning("lz4 unavailable, falling back to uncompressed transfer")
+                lz4_level = None
+
         size_bytes = 0
-        cmd = ""
+        stages = []
 
         if is_pull:
             # --- اصلاحیه رفع خطای TAR ---
             remote_full_path = os.path.join(REMOTE_BASE_DIR, REMOTE_TARGET_DIR_NAME)
-            size_bytes = get_remote_size(remote_full_path)
+            size_bytes = get_remote_size(remote_full_path, serial)
             
             if size_bytes == 0:
                 logger.warning("Remote size returned 0. Access check is mandatory.")
             
             os.makedirs(local_path, exist_ok=True)
             
-            cmd = (
-                f'adb exec-out "cd {REMOTE_BASE_DIR} && tar -c -f - {REMOTE_TARGET_DIR_NAME}" | '
-                f'pv -n -s {size_bytes} | '
-                f'tar -xf - -C "{local_path}"'
-            )
+            stages = build_pull_stages(local_path, size_bytes, lz4_level)
             logger.info(f"Pulling {REMOTE_TARGET_DIR_NAME} from {REMOTE_BASE_DIR}")
 
         else:
@@ -345,24 +925,20 @@ class ADBTransferApp(Adw.Application):
                 GLib.idle_add(self.on_transfer_finished, False, "Local path does not exist")
                 return
             
-            subprocess.run(["adb", "shell", "mkdir", "-p", DEVICE_DIR])
             size_bytes = get_local_size(local_path)
             
-            cmd = (
-                f'tar -cf - -C "{local_path}" . | '
-                f'pv -n -s {size_bytes} | '
-                f'adb shell "tar -xf - -C {DEVICE_DIR}"'
-            )
+            stages = build_push_stages(local_path, size_bytes, lz4_level)
             logger.info(f"Pushing files to {DEVICE_DIR}")
 
-        self.total_bytes = size_bytes
-        GLib.idle_add(lambda: self.status_label.set_text("Transferring..."))
-        
-        run_adb_command_with_progress(
-            cmd, 
-            self.update_ui_progress, 
-            self.on_transfer_finished
-        )
+        self._start_transfer(run_adb_command_with_progress, stages, size_bytes)
+
+    def _prepare_and_run_sync(self, local_path, serial):
+        remote_full_path = os.path.join(REMOTE_BASE_DIR, REMOTE_TARGET_DIR_NAME)
+        size_bytes = get_remote_size(remote_full_path, serial)
+        os.makedirs(local_path, exist_ok=True)
+        logger.info(f"Pulling {remote_full_path} with adb sync")
+
+        self._start_transfer(run_adb_pull_with_progress, remote_full_path, local_path, size_bytes)
 
 def main():
     app = ADBTransferApp()